@@ -8,6 +8,12 @@ import time
 import io
 import s3fs
 
+from search_engine import (
+    PUBLIC_HOSPITALS, MANAGER_HOSPITALS, ALL_VALID_HOSPITALS,
+    R2_PARQUET_PATH, R2_JSON_PATH, R2_METADATA_PATH, DISPLAY_COLS, RANKED_TOP_K,
+    ProductIndex, data_hash
+)
+
 # --- 1. 設定頁面配置 ---
 st.set_page_config(
     page_title="院內碼查詢系統", 
@@ -15,40 +21,7 @@ st.set_page_config(
     page_icon="🌿"
 )
 
-# --- 2. 設定：醫院白名單設定 (全域設定) ---
-
-# A. 公開顯示 (南區醫院)
-PUBLIC_HOSPITALS = [
-    "大林慈濟", "中國(祐新/銀鐸)", "中國北港(祐新/銀鐸)", "中國安南(祐新/銀鐸)", "中國新竹(祐新/銀鐸)",
-    "中榮", "天主教聖馬爾定醫院", "台南市立(秀傳)", "右昌", "台南新樓", "成大", "秀傳", "阮綜合",
-    "奇美永康", "奇美佳里", "奇美柳營", "東港安泰", "枋寮醫院", "屏東榮民總醫院", "屏東寶建", "屏基",
-    "高雄大同(長庚)", "高雄小港(高醫)", "高雄市立民生醫院", "高雄市立聯合醫院", "高雄岡山(高醫)",
-    "高雄長庚", "高雄榮民總醫院臺南分院", "高榮", "高醫", "健仁", "國軍左營", "國軍高雄",
-    "國軍高雄總醫院屏東分院", "郭綜合", "麻豆新樓", "義大", "嘉基", "嘉義長庚", "嘉義陽明",
-    "臺南新樓", "輔英(可用彰基院內碼)", "衛生福利部屏東醫院", "衛生福利部恆春旅遊醫院",
-    "衛生福利部新營醫院", "衛生福利部嘉義醫院", "衛生福利部旗山醫院", "衛生福利部臺南醫院",
-    "衛生福利部澎湖醫院"
-]
-
-# B. 噥噥專用 (特定醫院)
-MANAGER_HOSPITALS = [
-    "新店慈濟", "台北慈濟", 
-    "內湖三總", "三軍總醫院", 
-    "松山三總", "松山分院", 
-    "國立陽明大學",          
-    "國立陽明交通大學",      
-    "交通大學",              
-    "輔大", "羅東博愛", 
-    "衛生福利部臺北醫院", "部立臺北"
-]
-
-# C. 合併清單
-ALL_VALID_HOSPITALS = PUBLIC_HOSPITALS + MANAGER_HOSPITALS
-
-# R2 設定檔案路徑
-R2_PARQUET_PATH = "medical_products.parquet"
-R2_JSON_PATH = "medical_products.json"
-R2_METADATA_PATH = "metadata.json"
+# --- 2. 設定：醫院白名單與 R2 路徑 (定義於 search_engine.py，與查詢服務共用) ---
 
 # --- 3. CSS 樣式優化 ---
 st.markdown("""
@@ -415,7 +388,8 @@ def save_data_to_r2(df, updated_at, file_name):
         metadata = {
             'updated_at': updated_at,
             'file_name': file_name,
-            'record_count': len(df)
+            'record_count': len(df),
+            'data_hash': data_hash(df)
         }
         with fs.open(meta_key, 'w') as f:
             json.dump(metadata, f)
@@ -447,7 +421,8 @@ def load_data_from_r2():
             return {
                 'df': df, 
                 'updated_at': meta.get('updated_at', '未知'),
-                'file_name': meta.get('file_name', '未知檔案')
+                'file_name': meta.get('file_name', '未知檔案'),
+                'data_hash': meta.get('data_hash') or data_hash(df)
             }
         return None
     except Exception as e:
@@ -468,17 +443,15 @@ def clear_r2_data():
         st.error(f"清除 R2 失敗: {e}")
         return False
 
-def filter_hospitals(all_hospitals, allow_list):
-    filtered = []
-    for h in all_hospitals:
-        if "聯醫" in h or "北市聯醫" in h:
-            continue
+@st.cache_resource(max_entries=2, show_spinner=False)
+def build_product_index(content_hash, updated_at, file_version, _df):
+    """每個資料版本（內容雜湊）只建一次索引，所有 session 共用"""
+    return ProductIndex(_df, updated_at, file_version)
 
-        for allow in allow_list:
-            if allow == h or allow in h:
-                filtered.append(h)
-                break 
-    return sorted(list(set(filtered)))
+def get_product_index():
+    """依目前 session 的資料版本取得共用查詢索引"""
+    return build_product_index(st.session_state.data_hash, st.session_state.last_updated,
+                               st.session_state.file_version, st.session_state.data)
 
 # --- 5. 主程式 ---
 def main():
@@ -488,16 +461,19 @@ def main():
             st.session_state.data = db_content.get('df')
             st.session_state.last_updated = db_content.get('updated_at', "未知")
             st.session_state.file_version = db_content.get('file_name', "未知版本")
+            st.session_state.data_hash = db_content.get('data_hash', "")
         else:
             st.session_state.data = None
             st.session_state.last_updated = ""
             st.session_state.file_version = ""
+            st.session_state.data_hash = ""
 
     # 初始化其他變數
     if 'has_searched' not in st.session_state: st.session_state.has_searched = False
     if 'qry_hosp' not in st.session_state: st.session_state.qry_hosp = []
     if 'qry_code' not in st.session_state: st.session_state.qry_code = ""
     if 'qry_key' not in st.session_state: st.session_state.qry_key = ""
+    if 'qry_ranked' not in st.session_state: st.session_state.qry_ranked = False
     if 'is_manager_mode' not in st.session_state: st.session_state.is_manager_mode = False
 
     # --- 側邊欄 ---
@@ -528,9 +504,7 @@ def main():
              st.rerun()
 
         if st.session_state.data is not None and not st.session_state.data.empty:
-            df = st.session_state.data
-            all_db_hospitals = df['醫院名稱'].unique().tolist()
-            display_hosp_list = filter_hospitals(all_db_hospitals, MANAGER_HOSPITALS if st.session_state.is_manager_mode else PUBLIC_HOSPITALS)
+            display_hosp_list = get_product_index().hospitals(st.session_state.is_manager_mode)
             
             mode = st.radio("Display Mode", ["Single", "Multiple"], index=0, horizontal=True)
             
@@ -553,6 +527,7 @@ def main():
                 
                 st.markdown("#### 03. 關鍵字")
                 s_key = st.text_input("Keywords", value=st.session_state.qry_key, placeholder="型號 / 產品名", label_visibility="collapsed")
+                s_ranked = st.checkbox(f"模糊排序 (Top {RANKED_TOP_K})", value=st.session_state.qry_ranked, help="依型號相似度排序，可容忍打錯字；醫院名稱關鍵字仍為必要條件")
                 
                 st.markdown("<br>", unsafe_allow_html=True)
                 
@@ -561,10 +536,10 @@ def main():
                 with c2: btn_clear = st.form_submit_button("RESET")
             
             if btn_search:
-                st.session_state.qry_hosp = s_hosp; st.session_state.qry_code = s_code; st.session_state.qry_key = s_key
+                st.session_state.qry_hosp = s_hosp; st.session_state.qry_code = s_code; st.session_state.qry_key = s_key; st.session_state.qry_ranked = s_ranked
                 st.session_state.has_searched = True; st.rerun()
             if btn_clear:
-                st.session_state.qry_hosp = []; st.session_state.qry_code = ""; st.session_state.qry_key = ""; st.session_state.has_searched = False; st.rerun()
+                st.session_state.qry_hosp = []; st.session_state.qry_code = ""; st.session_state.qry_key = ""; st.session_state.qry_ranked = False; st.session_state.has_searched = False; st.rerun()
         else:
             st.info("No database initialized.")
 
@@ -602,6 +577,7 @@ def main():
                                     st.session_state.data = clean_df
                                     st.session_state.last_updated = update_time
                                     st.session_state.file_version = file_name
+                                    st.session_state.data_hash = data_hash(clean_df)
                                     st.success(f"✅ 已上傳 {len(clean_df)} 筆資料到 Cloudflare R2")
                                     time.sleep(1) # 讓使用者看一下成功訊息
                                     st.rerun()
@@ -614,35 +590,26 @@ def main():
 
     if st.session_state.data is not None and not st.session_state.data.empty:
         if st.session_state.has_searched:
-            df = st.session_state.data
-            filtered_df = df.copy()
-
-            all_db_hospitals = df['醫院名稱'].unique().tolist()
-            allowed_list = filter_hospitals(all_db_hospitals, MANAGER_HOSPITALS if st.session_state.is_manager_mode else PUBLIC_HOSPITALS)
-            filtered_df = filtered_df[filtered_df['醫院名稱'].isin(allowed_list)]
-
-            if st.session_state.qry_hosp: filtered_df = filtered_df[filtered_df['醫院名稱'].isin(st.session_state.qry_hosp)]
-            if st.session_state.qry_code:
-                k = st.session_state.qry_code.strip()
-                filtered_df = filtered_df[filtered_df['院內碼'].str.contains(k, case=False, na=False) | filtered_df['批價碼'].str.contains(k, case=False, na=False) | filtered_df['原始備註'].str.contains(k, case=False, na=False)]
-            if st.session_state.qry_key:
-                kws = st.session_state.qry_key.split()
-                for k in kws:
-                    k_clean = re.sub(r'[^a-zA-Z0-9]', '', k)
-                    # Bug 修復：將 regex 設為 False，避免型號內的正則符號 (如括號) 導致搜尋失敗
-                    m = (filtered_df['搜尋用字串'].str.contains(k, case=False, na=False, regex=False) | 
-                         filtered_df['原始備註'].str.contains(k, case=False, na=False, regex=False) | 
-                         filtered_df['醫院名稱'].str.contains(k, case=False, na=False, regex=False))
-                    if k_clean: 
-                        m = m | filtered_df['搜尋用字串'].str.contains(k_clean, case=False, na=False, regex=False)
-                    filtered_df = filtered_df[m]
+            if st.session_state.qry_ranked and st.session_state.qry_key.strip():
+                filtered_df = get_product_index().ranked_search(
+                    st.session_state.qry_key,
+                    hospitals=st.session_state.qry_hosp,
+                    code=st.session_state.qry_code,
+                    is_manager_mode=st.session_state.is_manager_mode
+                )
+            else:
+                filtered_df = get_product_index().search(
+                    hospitals=st.session_state.qry_hosp,
+                    code=st.session_state.qry_code,
+                    keywords=st.session_state.qry_key,
+                    is_manager_mode=st.session_state.is_manager_mode
+                )
 
             # 顯示結果
             if not filtered_df.empty:
                 st.markdown(f"**Results:** {len(filtered_df)} items found")
-                display_cols = ['醫院名稱', '產品名稱', '型號', '院內碼', '批價碼']
                 
-                styled_df = filtered_df[display_cols].style\
+                styled_df = filtered_df[DISPLAY_COLS].style\
                     .set_properties(**{
                         'background-color': '#FFFFFF',
                         'color': '#4A4A4A',
@@ -0,0 +1,268 @@
+"""
+院內碼查詢服務 (獨立 HTTP JSON API)
+
+與 Streamlit 介面共用 search_engine.py 的白名單與查詢邏輯，
+但資料只載入一次並常駐記憶體，每次查詢不需重跑整個 Streamlit 腳本。
+
+啟動：
+    cd src
+    python query_service.py --port 8502
+
+端點：
+    GET /health                              目前資料版本
+    GET /hospitals                           可選醫院清單
+    GET /search?hospital=高醫&code=&q=型號     與側邊欄表單相同語意
+    GET /search?q=型號&ranked=1&k=20           模糊排序，只回傳前 k 筆
+                                             （符合醫院名稱的關鍵字仍為必要條件）
+    GET /code/<院內碼>                        代碼查詢
+
+Admin 模式：設定環境變數 QUERY_MANAGER_KEY，請求帶 X-Manager-Key 標頭且相符時
+改用噥噥專用醫院清單；未設定則僅提供公開清單。
+
+R2 連線設定優先讀取環境變數 R2_ACCESS_KEY_ID / R2_SECRET_ACCESS_KEY /
+R2_ENDPOINT_URL / R2_BUCKET_NAME，否則讀取 .streamlit/secrets.toml 的 [r2] 區段。
+"""
+import argparse
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+import pandas as pd
+import s3fs
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11 僅支援環境變數設定
+    tomllib = None
+
+from search_engine import (
+    R2_PARQUET_PATH, R2_METADATA_PATH, DISPLAY_COLS, RANKED_TOP_K,
+    ProductIndex, IndexHolder, records
+)
+
+logger = logging.getLogger("query_service")
+
+SECRETS_PATH = os.path.join(".streamlit", "secrets.toml")
+
+
+# === 資料來源 ===
+
+def load_r2_config():
+    """讀取 R2 連線設定（環境變數優先）"""
+    env_keys = {
+        'access_key_id': 'R2_ACCESS_KEY_ID',
+        'secret_access_key': 'R2_SECRET_ACCESS_KEY',
+        'endpoint_url': 'R2_ENDPOINT_URL',
+        'bucket_name': 'R2_BUCKET_NAME',
+    }
+    if all(os.environ.get(v) for v in env_keys.values()):
+        return {k: os.environ[v] for k, v in env_keys.items()}
+
+    if tomllib is None:
+        raise RuntimeError("請設定 R2_* 環境變數（此 Python 版本無法讀取 secrets.toml）")
+    with open(SECRETS_PATH, 'rb') as f:
+        return tomllib.load(f)["r2"]
+
+
+class R2Source:
+    """從 R2 讀取 metadata.json 與 Parquet"""
+
+    def __init__(self, r2_config):
+        self.fs = s3fs.S3FileSystem(
+            key=r2_config["access_key_id"],
+            secret=r2_config["secret_access_key"],
+            endpoint_url=r2_config["endpoint_url"]
+        )
+        self.bucket = r2_config["bucket_name"]
+
+    def read_metadata(self):
+        self.fs.invalidate_cache()
+        with self.fs.open(f"{self.bucket}/{R2_METADATA_PATH}", 'r') as f:
+            return json.load(f)
+
+    def read_df(self):
+        with self.fs.open(f"{self.bucket}/{R2_PARQUET_PATH}", 'rb') as f:
+            return pd.read_parquet(f, engine='pyarrow')
+
+
+class LocalSource:
+    """讀取本機 Parquet（開發用），以檔案修改時間作為版本"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def read_metadata(self):
+        return {
+            'updated_at': str(os.path.getmtime(self.path)),
+            'file_name': os.path.basename(self.path)
+        }
+
+    def read_df(self):
+        return pd.read_parquet(self.path, engine='pyarrow')
+
+
+def version_of(meta):
+    return (meta.get('updated_at', ''), meta.get('file_name', ''), meta.get('data_hash', ''))
+
+
+def refresh(holder, source):
+    """資料版本變更時載入新資料並替換索引，回傳是否已更新"""
+    meta = source.read_metadata()
+    version = version_of(meta)
+    if holder.get() is not None and holder.version == version:
+        return False
+
+    # 新索引完整建好後才替換，替換前的查詢仍使用舊版本
+    df = source.read_df()
+    new_index = ProductIndex(df, meta.get('updated_at', ''), meta.get('file_name', ''))
+    holder.swap(new_index, version)
+    logger.info("已載入資料版本 %s (%s)，共 %d 筆", new_index.file_name, new_index.updated_at, len(new_index))
+    return True
+
+
+def start_watcher(holder, source, interval):
+    """背景定期檢查 metadata.json，有新版本即熱替換"""
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                refresh(holder, source)
+            except Exception as e:
+                logger.warning("資料更新檢查失敗，沿用目前版本: %s", e)
+
+    t = threading.Thread(target=loop, name="index-watcher", daemon=True)
+    t.start()
+    return t
+
+
+# === HTTP 端點 ===
+
+def make_handler(holder, manager_key):
+
+    class QueryHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+        def send_json(self, status, payload):
+            body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def is_manager_mode(self):
+            key = self.headers.get("X-Manager-Key", "")
+            return bool(manager_key) and hmac.compare_digest(key.encode('utf-8'), manager_key.encode('utf-8'))
+
+        def result_payload(self, index, df):
+            return {
+                'updated_at': index.updated_at,
+                'file_name': index.file_name,
+                'count': len(df),
+                'results': records(df, DISPLAY_COLS)
+            }
+
+        def do_GET(self):
+            index = holder.get()
+            if index is None:
+                self.send_json(503, {'error': '資料庫尚未載入'})
+                return
+
+            try:
+                self.dispatch(index)
+            except Exception as e:
+                logger.exception("查詢失敗: %s", self.path)
+                self.send_json(500, {'error': f'查詢失敗: {e}'})
+
+        def dispatch(self, index):
+            # http.server 以 ISO-8859-1 解讀請求行；還原未編碼的 UTF-8（如 curl 直接送出中文）
+            try:
+                raw_path = self.path.encode('latin-1').decode('utf-8')
+            except UnicodeError:
+                self.send_json(400, {'error': '查詢字串必須為 UTF-8'})
+                return
+
+            url = urlparse(raw_path)
+            params = parse_qs(url.query)
+            path = url.path.rstrip('/')
+            manager = self.is_manager_mode()
+
+            if path == "/health":
+                self.send_json(200, {
+                    'updated_at': index.updated_at,
+                    'file_name': index.file_name,
+                    'record_count': len(index)
+                })
+            elif path == "/hospitals":
+                self.send_json(200, {'hospitals': index.hospitals(manager)})
+            elif path == "/search":
+                keywords = params.get('q', [''])[0]
+                if params.get('ranked', ['0'])[0] == '1' and keywords.strip():
+                    try:
+                        k = int(params.get('k', [RANKED_TOP_K])[0])
+                    except ValueError:
+                        self.send_json(400, {'error': 'k 必須為整數'})
+                        return
+                    df = index.ranked_search(
+                        keywords,
+                        k=max(k, 1),
+                        hospitals=params.get('hospital', []),
+                        code=params.get('code', [''])[0],
+                        is_manager_mode=manager
+                    )
+                else:
+                    df = index.search(
+                        hospitals=params.get('hospital', []),
+                        code=params.get('code', [''])[0],
+                        keywords=keywords,
+                        is_manager_mode=manager
+                    )
+                self.send_json(200, self.result_payload(index, df))
+            elif path.startswith("/code/"):
+                df = index.lookup_code(unquote(path[len("/code/"):]), is_manager_mode=manager)
+                self.send_json(200, self.result_payload(index, df))
+            else:
+                self.send_json(404, {'error': f'未知路徑: {url.path}'})
+
+    return QueryHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="院內碼查詢服務")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8502)
+    parser.add_argument("--parquet", help="改用本機 Parquet 檔（不連線 R2）")
+    parser.add_argument("--poll", type=float, default=60, help="檢查新資料版本的間隔秒數")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    source = LocalSource(args.parquet) if args.parquet else R2Source(load_r2_config())
+    holder = IndexHolder()
+    try:
+        refresh(holder, source)
+    except Exception as e:
+        logger.warning("初次載入失敗，將於背景重試: %s", e)
+    start_watcher(holder, source, args.poll)
+
+    handler = make_handler(holder, os.environ.get("QUERY_MANAGER_KEY", ""))
+    server = ThreadingHTTPServer((args.host, args.port), handler)
+    logger.info("查詢服務啟動於 http://%s:%d", args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+# --- 醫院白名單設定 (全域設定，Streamlit 介面與查詢服務共用) ---
+
+# A. 公開顯示 (南區醫院)
+PUBLIC_HOSPITALS = [
+    "大林慈濟", "中國(祐新/銀鐸)", "中國北港(祐新/銀鐸)", "中國安南(祐新/銀鐸)", "中國新竹(祐新/銀鐸)",
+    "中榮", "天主教聖馬爾定醫院", "台南市立(秀傳)", "右昌", "台南新樓", "成大", "秀傳", "阮綜合",
+    "奇美永康", "奇美佳里", "奇美柳營", "東港安泰", "枋寮醫院", "屏東榮民總醫院", "屏東寶建", "屏基",
+    "高雄大同(長庚)", "高雄小港(高醫)", "高雄市立民生醫院", "高雄市立聯合醫院", "高雄岡山(高醫)",
+    "高雄長庚", "高雄榮民總醫院臺南分院", "高榮", "高醫", "健仁", "國軍左營", "國軍高雄",
+    "國軍高雄總醫院屏東分院", "郭綜合", "麻豆新樓", "義大", "嘉基", "嘉義長庚", "嘉義陽明",
+    "臺南新樓", "輔英(可用彰基院內碼)", "衛生福利部屏東醫院", "衛生福利部恆春旅遊醫院",
+    "衛生福利部新營醫院", "衛生福利部嘉義醫院", "衛生福利部旗山醫院", "衛生福利部臺南醫院",
+    "衛生福利部澎湖醫院"
+]
+
+# B. 噥噥專用 (特定醫院)
+MANAGER_HOSPITALS = [
+    "新店慈濟", "台北慈濟",
+    "內湖三總", "三軍總醫院",
+    "松山三總", "松山分院",
+    "國立陽明大學",
+    "國立陽明交通大學",
+    "交通大學",
+    "輔大", "羅東博愛",
+    "衛生福利部臺北醫院", "部立臺北"
+]
+
+# C. 合併清單
+ALL_VALID_HOSPITALS = PUBLIC_HOSPITALS + MANAGER_HOSPITALS
+
+# R2 設定檔案路徑
+R2_PARQUET_PATH = "medical_products.parquet"
+R2_JSON_PATH = "medical_products.json"
+R2_METADATA_PATH = "metadata.json"
+
+# 結果顯示欄位
+DISPLAY_COLS = ['醫院名稱', '產品名稱', '型號', '院內碼', '批價碼']
+
+# 排序查詢：預設回傳筆數與最低相似度
+RANKED_TOP_K = 50
+RANKED_MIN_SCORE = 0.3
+# 排序查詢中視為醫院條件的關鍵字：需等於醫院名稱，或為醫院名稱開頭且至少此長度
+HOSPITAL_TERM_MIN_LEN = 2
+
+
+def filter_hospitals(all_hospitals, allow_list):
+    filtered = []
+    for h in all_hospitals:
+        if "聯醫" in h or "北市聯醫" in h:
+            continue
+
+        for allow in allow_list:
+            if allow == h or allow in h:
+                filtered.append(h)
+                break
+    return sorted(list(set(filtered)))
+
+
+def data_hash(df):
+    """資料內容雜湊，作為資料版本識別（updated_at 只到分鐘，同名同筆數重傳時無法分辨）"""
+    return format(int(pd.util.hash_pandas_object(df, index=False).sum()), 'x')
+
+
+def clean_model(text):
+    """型號正規化：只保留英數字並轉小寫（與 process_data 的 m_clean 相同規則）"""
+    return re.sub(r'[^a-zA-Z0-9]', '', text).lower()
+
+
+def trigrams(text):
+    """依空白切詞，每個詞前補兩格、後補一格後取三字元組（同 pg_trgm）"""
+    grams = set()
+    for word in text.lower().split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class TrigramIndex:
+    """三字元組倒排索引：trigram -> 含有該 trigram 的文件編號"""
+
+    def __init__(self, docs):
+        postings = {}
+        self.sizes = np.zeros(len(docs), dtype=np.int32)
+        for doc_id, text in enumerate(docs):
+            grams = trigrams(text)
+            self.sizes[doc_id] = len(grams)
+            for g in grams:
+                postings.setdefault(g, []).append(doc_id)
+        self.postings = {g: np.array(ids, dtype=np.int32) for g, ids in postings.items()}
+
+    def overlap(self, grams):
+        """回傳每份文件與查詢共有的 trigram 數"""
+        hits = [self.postings[g] for g in grams if g in self.postings]
+        if not hits:
+            return np.zeros(len(self.sizes), dtype=np.int32)
+        return np.bincount(np.concatenate(hits), minlength=len(self.sizes))
+
+
+class ProductIndex:
+    """載入後的資料集與預先計算的查詢欄位（不可變，換版時整個替換）"""
+
+    def __init__(self, df, updated_at="", file_name=""):
+        self.df = df.reset_index(drop=True)
+        self.updated_at = updated_at
+        self.file_name = file_name
+
+        # 預先轉小寫，避免每次查詢都對整欄做 case=False 轉換
+        self._lower = {
+            col: self.df[col].fillna('').astype(str).str.lower()
+            for col in ['搜尋用字串', '原始備註', '醫院名稱']
+        }
+
+        # 依權限模式預先計算可見醫院
+        all_db_hospitals = self.df['醫院名稱'].unique().tolist()
+        self._allowed = {
+            False: filter_hospitals(all_db_hospitals, PUBLIC_HOSPITALS),
+            True: filter_hospitals(all_db_hospitals, MANAGER_HOSPITALS),
+        }
+        self._allowed_mask = {
+            mode: self.df['醫院名稱'].isin(hosps).to_numpy()
+            for mode, hosps in self._allowed.items()
+        }
+        # 排序查詢用：資料中的醫院名稱與白名單簡稱
+        self._hospital_names = {
+            False: {h.lower() for h in self._allowed[False] + PUBLIC_HOSPITALS},
+            True: {h.lower() for h in self._allowed[True] + MANAGER_HOSPITALS},
+        }
+
+        # 排序查詢索引：同一產品在各醫院重複出現，只對不重複的搜尋字串建索引
+        codes, uniques = pd.factorize(self._lower['搜尋用字串'])
+        self._doc_of_row = codes
+        doc_models = self.df['型號'].fillna('').astype(str).groupby(codes).first()
+        doc_m_clean = [clean_model(m) for m in doc_models]
+        self._model_trgm = TrigramIndex(doc_m_clean)
+        self._search_trgm = TrigramIndex(list(uniques))
+        self._m_clean_docs = {}
+        for doc_id, m_clean in enumerate(doc_m_clean):
+            if m_clean:
+                self._m_clean_docs.setdefault(m_clean, []).append(doc_id)
+
+    def __len__(self):
+        return len(self.df)
+
+    def hospitals(self, is_manager_mode=False):
+        """側邊欄可選的醫院清單"""
+        return self._allowed[is_manager_mode]
+
+    def _filter_mask(self, hospitals, code, is_manager_mode):
+        """權限、醫院與代碼條件"""
+        mask = self._allowed_mask[is_manager_mode].copy()
+        df = self.df
+
+        if hospitals:
+            mask &= df['醫院名稱'].isin(hospitals).to_numpy()
+
+        if code:
+            k = code.strip()
+            # regex=False：院內碼常含括號，如 #1809411(610132)
+            m = (df['院內碼'].str.contains(k, case=False, na=False, regex=False) |
+                 df['批價碼'].str.contains(k, case=False, na=False, regex=False) |
+                 df['原始備註'].str.contains(k, case=False, na=False, regex=False))
+            mask &= m.to_numpy()
+        return mask
+
+    def _keyword_mask(self, k):
+        """單一關鍵字：搜尋用字串 / 原始備註 / 醫院名稱 包含比對"""
+        k_lower = k.lower()
+        k_clean = re.sub(r'[^a-zA-Z0-9]', '', k).lower()
+        # 將 regex 設為 False，避免型號內的正則符號 (如括號) 導致搜尋失敗
+        m = (self._lower['搜尋用字串'].str.contains(k_lower, regex=False) |
+             self._lower['原始備註'].str.contains(k_lower, regex=False) |
+             self._lower['醫院名稱'].str.contains(k_lower, regex=False))
+        if k_clean:
+            m = m | self._lower['搜尋用字串'].str.contains(k_clean, regex=False)
+        return m.to_numpy()
+
+    def search(self, hospitals=None, code="", keywords="", is_manager_mode=False):
+        """與側邊欄表單相同語意的查詢：醫院 AND 代碼 AND 每個關鍵字"""
+        mask = self._filter_mask(hospitals, code, is_manager_mode)
+
+        if keywords:
+            for k in keywords.split():
+                mask &= self._keyword_mask(k)
+
+        return self.df[mask]
+
+    def _is_hospital_term(self, term, is_manager_mode):
+        """關鍵字是否指定醫院（整個名稱或名稱開頭），避免「高」「醫」等單字被當成醫院條件"""
+        t = term.lower()
+        return any(
+            t == h or (len(t) >= HOSPITAL_TERM_MIN_LEN and h.startswith(t))
+            for h in self._hospital_names[is_manager_mode]
+        )
+
+    def ranked_search(self, keywords, k=RANKED_TOP_K, hospitals=None, code="",
+                      is_manager_mode=False, min_score=RANKED_MIN_SCORE):
+        """
+        依 型號 / 搜尋用字串 的 trigram 相似度排序，只回傳前 k 筆（可容忍打錯字）
+        排序：型號完全相符且所有關鍵字皆包含 > 所有關鍵字皆包含 > 型號完全相符
+              > 型號相似度 / 搜尋字串涵蓋率；同分依資料列順序
+        等於醫院名稱或為其開頭的關鍵字（如「高醫 導管」的「高醫」）與一般查詢相同，
+        為必要條件；只有醫院關鍵字時依資料列順序回傳前 k 筆，不排序
+        單一關鍵字且完全相符的型號已足 k 筆時提前回傳；否則會對所有不重複字串計分，
+        僅以 np.partition 避免對全部候選排序
+        """
+        mask = self._filter_mask(hospitals, code, is_manager_mode)
+
+        fuzzy_terms = []
+        substring_hit = np.ones(len(self.df), dtype=bool)
+        for term in keywords.split():
+            term_mask = self._keyword_mask(term)
+            if self._is_hospital_term(term, is_manager_mode):
+                mask &= term_mask
+            else:
+                fuzzy_terms.append(term)
+                substring_hit &= term_mask
+
+        if not fuzzy_terms:
+            return self.df[mask].head(k)
+
+        keywords = " ".join(fuzzy_terms)
+        q_clean = clean_model(keywords)
+
+        # 各關鍵字分別比對 m_clean（「ABC123 縫線」只有 ABC123 是型號）
+        exact_docs = sorted({
+            doc_id
+            for term in fuzzy_terms
+            for doc_id in self._m_clean_docs.get(clean_model(term), [])
+        })
+
+        # 單一型號關鍵字且完全相符已足 k 筆時直接回傳，不需計算相似度
+        if len(fuzzy_terms) == 1:
+            exact_rows = np.flatnonzero(mask & np.isin(self._doc_of_row, exact_docs))
+            if len(exact_rows) >= k:
+                return self.df.iloc[exact_rows[:k]]
+
+        # 型號：以 m_clean 的 Jaccard 相似度計分
+        q_model = trigrams(q_clean)
+        shared = self._model_trgm.overlap(q_model)
+        union = self._model_trgm.sizes + len(q_model) - shared
+        model_score = np.divide(shared, union, out=np.zeros(len(shared)), where=union > 0)
+
+        # 搜尋用字串：以查詢 trigram 被涵蓋的比例計分（字串含產品名等，長度不宜納入分母）
+        q_search = trigrams(keywords)
+        search_score = self._search_trgm.overlap(q_search) / max(len(q_search), 1)
+
+        doc_score = np.maximum(model_score, search_score)
+        if exact_docs:
+            doc_score[exact_docs] = 1.5
+
+        # 包含比對命中者（如中文品名的一部分，trigram 無法比對）一律高於相似度門檻
+        score = doc_score[self._doc_of_row] + substring_hit
+        candidates = np.flatnonzero(mask & (score >= min_score))
+        if len(candidates) > k:
+            # 以第 k 高分為門檻篩掉其餘候選（保留同分者），不對全部命中結果排序
+            kth = np.partition(-score[candidates], k - 1)[k - 1]
+            candidates = candidates[-score[candidates] <= kth]
+        # 同分依資料列順序，結果固定
+        order = candidates[np.lexsort((candidates, -score[candidates]))][:k]
+        return self.df.iloc[order]
+
+    def lookup_code(self, code, is_manager_mode=False):
+        """側邊欄「02. 輸入代碼」：院內碼 / 批價碼 / 原始備註 包含查詢"""
+        if not code or not code.strip():
+            return self.df.iloc[0:0]
+        return self.search(code=code, is_manager_mode=is_manager_mode)
+
+
+class IndexHolder:
+    """
+    持有目前版本的 ProductIndex；換版時以單一參照替換，查詢中的請求不受影響
+    只由背景更新執行緒呼叫 swap()；參照指派本身為原子操作，不需加鎖
+    """
+
+    def __init__(self, index=None):
+        self._index = index
+        self.version = None
+
+    def get(self):
+        return self._index
+
+    def swap(self, new_index, version=None):
+        old = self._index
+        self._index = new_index
+        self.version = version
+        return old
+
+
+def records(df, columns=None):
+    """將查詢結果轉為 JSON 可序列化的 list[dict]"""
+    if columns:
+        df = df[[c for c in columns if c in df.columns]]
+    return df.fillna('').astype(str).to_dict(orient='records')